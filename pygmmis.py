@@ -1,6 +1,6 @@
-from __future__ import division
 import numpy as np
-import scipy.special, scipy.stats
+import math
+import scipy.special, scipy.stats, scipy.linalg, scipy.sparse
 import ctypes
 
 import logging
@@ -8,8 +8,15 @@ logger = logging.getLogger("pygmmis")
 
 # set up multiprocessing
 import multiprocessing
+import multiprocessing.pool
 import parmap
 
+# optional: jit-compiled kernels
+try:
+    import numba
+except ImportError:
+    numba = None
+
 def createShared(a, dtype=ctypes.c_double):
     """Create a shared array to be used for multiprocessing's processes.
 
@@ -21,47 +28,26 @@ def createShared(a, dtype=ctypes.c_double):
         numpy array, arbitrary shape
 
     Returns:
-        numpy array whose container is a multiprocessing.Array
+        numpy array whose container is a multiprocessing.RawArray
     """
-    shared_array_base = multiprocessing.Array(dtype, a.size)
-    shared_array = np.ctypeslib.as_array(shared_array_base.get_obj())
-    shared_array[:] = a.flatten()
-    shared_array = shared_array.reshape(a.shape)
+    # no lock needed: workers only read from the array
+    shared_array_base = multiprocessing.RawArray(dtype, a.size)
+    shared_array = np.ctypeslib.as_array(shared_array_base).reshape(a.shape)
+    np.copyto(shared_array, a)
     return shared_array
 
-# this is to allow multiprocessing pools to operate on class methods:
-# https://gist.github.com/bnyeggen/1086393
-def _pickle_method(method):
-	func_name = method.__func__.__name__ # func_name = method.im_func.__name__
-	obj = method.__self__ # obj = method.im_self
-	cls = method.__self__.__class__# cls = method.im_class
-	if func_name.startswith('__') and not func_name.endswith('__'): #deal with mangled names
-		cls_name = cls.__name__.lstrip('_')
-		func_name = '_' + cls_name + func_name
-	return _unpickle_method, (func_name, obj, cls)
-
-def _unpickle_method(func_name, obj, cls):
-	for cls in cls.__mro__:
-		try:
-			func = cls.__dict__[func_name]
-		except KeyError:
-			pass
-		else:
-			break
-	return func.__get__(obj, cls)
-
-import types
-# python 2 -> 3 adjustments
-try:
-    import copy_reg
-except ImportError:
-    import copyreg as copy_reg
-copy_reg.pickle(types.MethodType, _pickle_method, _unpickle_method)
+# number of samples per tile when evaluating all components at once
+_TILE = 2048
 
-try:
-    xrange
-except NameError:
-    xrange = range
+# maximum size (in bytes) of temporary arrays for evaluating all components at once
+_MAX_BATCH_BYTES = 2**28
+
+# floating-point type of chi2 in the batched E-step: np.float32 halves the
+# memory traffic, but loses precision for badly conditioned covariances
+_ESTEP_DTYPE = np.float64
+
+# log(2 pi) for the normalization of the Gaussians
+_LOG2PI = math.log(2*math.pi)
 
 # Blantant copy from Erin Sheldon's esutil
 # https://github.com/esheldon/esutil/blob/master/esutil/numpy_util.py
@@ -100,31 +86,26 @@ def match1d(arr1input, arr2input, presorted=False):
         mess="Error: arr1 and arr2 must each be non-zero length"
         raise ValueError(mess)
 
-    # make sure that arr1 has unique values...
-    test=np.unique(arr1)
-    if test.size != arr1.size:
-        raise ValueError("Error: the arr1input must be unique")
-
     # sort arr1 if not presorted
     if not presorted:
         st1 = np.argsort(arr1)
+        sorted1 = arr1[st1]
     else:
         st1 = None
+        sorted1 = arr1
 
-    # search the sorted array
-    sub1=np.searchsorted(arr1,arr2,sorter=st1)
+    # make sure that arr1 has unique values, i.e. no equal neighbors when sorted
+    if (sorted1[1:] == sorted1[:-1]).any():
+        raise ValueError("Error: the arr1input must be unique")
 
-    # check for out-of-bounds at the high end if necessary
-    if (arr2.max() > arr1.max()) :
-        bad,=np.where(sub1 == arr1.size)
-        sub1[bad] = arr1.size-1
+    # search the sorted array, clip out-of-bounds at the high end
+    sub1 = np.searchsorted(sorted1, arr2)
+    np.clip(sub1, 0, sorted1.size-1, out=sub1)
 
-    if not presorted:
-        sub2,=np.where(arr1[st1[sub1]] == arr2)
-        sub1=st1[sub1[sub2]]
-    else:
-        sub2,=np.where(arr1[sub1] == arr2)
-        sub1=sub1[sub2]
+    sub2, = np.where(sorted1[sub1] == arr2)
+    sub1 = sub1[sub2]
+    if st1 is not None:
+        sub1 = st1[sub1]
 
     return sub1,sub2
 
@@ -132,8 +113,8 @@ def match1d(arr1input, arr2input, presorted=False):
 def logsum(logX, axis=0):
     """Computes log of the sum along give axis from the log of the summands.
 
-    This method tries hard to avoid over- or underflow.
-    See appendix A of Bovy, Hogg, Roweis (2009).
+    Shifts the summands by their maximum along axis to avoid over- or
+    underflow (see appendix A of Bovy, Hogg, Roweis (2009)).
 
     Args:
         logX: numpy array of logarithmic summands
@@ -146,16 +127,13 @@ def logsum(logX, axis=0):
         ValueError if logX has length 0 along given axis
 
     """
-    floatinfo = np.finfo(logX.dtype)
-    underflow = np.log(floatinfo.tiny) - logX.min(axis=axis)
-    overflow = np.log(floatinfo.max) - logX.max(axis=axis) - np.log(logX.shape[axis])
-    c = np.where(underflow < overflow, underflow, overflow)
-    # adjust the shape of c for addition with logX
-    c_shape = [slice(None) for i in xrange(len(logX.shape))]
-    c_shape[axis] = None
-    return np.log(np.exp(logX + c[tuple(c_shape)]).sum(axis=axis)) - c
+    return scipy.special.logsumexp(logX, axis=axis)
 
 
+# log-determinant of C = L L^T from its (batch of) Cholesky factor(s) L
+def _logdet_chol(L):
+    return 2*np.log(np.diagonal(L, axis1=-2, axis2=-1)).sum(axis=-1)
+
 def chi2_cutoff(D, cutoff=3.):
     """D-dimensional eqiuvalent of "n sigma" cut.
 
@@ -184,6 +162,96 @@ def covar_callback_default(coords, default=None):
     return default
 
 
+if numba is not None:
+    @numba.njit(cache=True)
+    def _cholesky_numba(A):
+        # lower-triangular L with A = L L^T,
+        # L[0,0] = nan if A is not positive definite
+        D = A.shape[0]
+        L = np.zeros((D, D))
+        for a in range(D):
+            for b in range(a+1):
+                s = A[a,b]
+                for c in range(b):
+                    s -= L[a,c] * L[b,c]
+                if a == b:
+                    if s <= 0:
+                        L[0,0] = np.nan
+                        return L
+                    L[a,a] = np.sqrt(s)
+                else:
+                    L[a,b] = s / L[b,b]
+        return L
+
+    @numba.njit(parallel=True, cache=True)
+    def _chi2_logdet_numba(dx, C_k, covar):
+        # chi2 = dx^T T^-1 dx and log(det(T)) for T = C_k + covar_i,
+        # covar has shape (1,D,D) for one-for-all or (N,D,D)
+        N, D = dx.shape
+        chi2 = np.empty(N)
+        logdet = np.empty(N)
+        shared = covar.shape[0] == 1
+        # factorize once if shared, covar[0] need not exist otherwise
+        if shared:
+            L0 = _cholesky_numba(C_k + covar[0])
+        else:
+            L0 = np.empty((D, D))
+        for i in numba.prange(N):
+            if shared:
+                L = L0
+            else:
+                L = _cholesky_numba(C_k + covar[i])
+            # forward substitution L z = dx_i
+            z = np.empty(D)
+            chi2_i = 0.
+            logdet_i = 0.
+            for a in range(D):
+                s = dx[i,a]
+                for b in range(a):
+                    s -= L[a,b] * z[b]
+                z[a] = s / L[a,a]
+                chi2_i += z[a]**2
+                logdet_i += 2*np.log(L[a,a])
+            chi2[i] = chi2_i
+            logdet[i] = logdet_i
+        return chi2, logdet
+
+    @numba.njit(parallel=True, cache=True)
+    def _noise_numba(covar, z):
+        # noise_i = L_i z_i with L_i L_i^T = covar_i, without storing the L_i;
+        # noise_i = nan if covar_i is not positive definite
+        N, D = z.shape
+        noise = np.empty((N, D))
+        for i in numba.prange(N):
+            L = _cholesky_numba(covar[i])
+            for a in range(D):
+                s = 0.
+                for b in range(a+1):
+                    s += L[a,b] * z[i,b]
+                noise[i,a] = s
+        return noise
+
+    @numba.njit(nogil=True, cache=True)
+    def _moments_numba(d, q, mu):
+        # M = sum_i q_i x_i and C = sum_i q_i (x_i - mu)(x_i - mu)^T in one pass
+        # NOTE: serial and without the GIL: _Msums already runs in a thread per k
+        N, D = d.shape
+        M = np.zeros(D)
+        C = np.zeros((D, D))
+        dm = np.empty(D)
+        for i in range(N):
+            for a in range(D):
+                M[a] += q[i] * d[i,a]
+                dm[a] = d[i,a] - mu[a]
+            for a in range(D):
+                qdm = q[i] * dm[a]
+                for b in range(a+1):
+                    C[a,b] += qdm * dm[b]
+        for a in range(D):
+            for b in range(a):
+                C[b,a] = C[a,b]
+        return M, C
+
 class GMM(object):
     """Gaussian mixture model with K components in D dimensions.
 
@@ -194,10 +262,74 @@ class GMM(object):
     """
     def __init__(self, K=0, D=0):
         """Create the arrays for amp, mean, covar."""
+        self._log_amp = self._log_amp_amp = None
         self.amp = np.zeros((K))
         self.mean = np.empty((K,D))
         self.covar = np.empty((K,D,D))
 
+    @property
+    def covar(self):
+        """numpy array (K,D,D): component covariances."""
+        return self._covar
+
+    @covar.setter
+    def covar(self, covar):
+        self._covar = covar
+        # invalidate cached factorization
+        self._L = self._L_covar = self._logdet = None
+
+    def _prepare_gaussian(self):
+        # Cholesky factors and log-determinants of all component covariances,
+        # cached until covar changes (by assignment or in place)
+        if self._L is None or not np.array_equal(self._L_covar, self.covar):
+            self._L = np.linalg.cholesky(self.covar)
+            self._logdet = _logdet_chol(self._L)
+            self._L_covar = self.covar.copy()
+        return self._L, self._logdet
+
+    def _prepare_gaussian_k(self, k):
+        # Cholesky factor and log-determinant of covar[k] only, in the same cache:
+        # loops over k must not compare or factorize all components each time
+        if self._L is None or self._L_covar.shape != self.covar.shape:
+            self._L = np.empty_like(self.covar)
+            self._logdet = np.empty(self.K)
+            # nan never compares equal, so that each component is factorized once
+            self._L_covar = np.full_like(self.covar, np.nan)
+        if not np.array_equal(self._L_covar[k], self.covar[k]):
+            self._L[k] = np.linalg.cholesky(self.covar[k])
+            self._logdet[k] = _logdet_chol(self._L[k])
+            self._L_covar[k] = self.covar[k]
+        return self._L[k], self._logdet[k]
+
+    def _prepare_log_amp(self):
+        # log of the amplitudes, cached until amp changes
+        if self._log_amp is None or not np.array_equal(self._log_amp_amp, self.amp):
+            self._log_amp = np.log(self.amp)
+            self._log_amp_amp = self.amp.copy()
+        return self._log_amp
+
+    @property
+    def _log2piD2(self):
+        # log of the normalization (2 pi)^(D/2) of the Gaussians
+        return 0.5*self.D*_LOG2PI
+
+    def chi2_and_logdet(self, k, dx):
+        """Chi-squared and log-determinant for component k.
+
+        Uses the cached Cholesky factor of covar[k].
+
+        Args:
+            k (int): component index
+            dx: numpy array (D,) or (N, D) of offsets from mean[k]
+
+        Returns:
+            chi2: float or numpy array (N,) of dx^T Sigma_k^-1 dx
+            logdet (float): log(det(Sigma_k))
+        """
+        L_k, logdet_k = self._prepare_gaussian_k(k)
+        z = scipy.linalg.solve_triangular(L_k, dx.T, lower=True).T
+        return np.einsum('...i,...i', z, z), logdet_k
+
     @property
     def K(self):
         """int: number of components, depends on size of amp."""
@@ -266,16 +398,23 @@ class GMM(object):
         """
         # draw indices for components given amplitudes, need to make sure: sum=1
         ind = rng.choice(self.K, size=size, p=self.amp/self.amp.sum())
-        N = np.bincount(ind, minlength=self.K)
 
-        # for each component: draw as many points as in ind from a normal
-        samples = np.empty((size, self.D))
-        lower = 0
-        for k in np.flatnonzero(N):
-            upper = lower + N[k]
-            samples[lower:upper, :] = rng.multivariate_normal(self.mean[k], self.covar[k], size=N[k])
-            lower = upper
-        return samples
+        # transform unit normal samples with the cached Cholesky factors:
+        # x = mean_k + L_k z, with covar_k = L_k L_k^T and z ~ N(0, 1)
+        try:
+            L, _ = self._prepare_gaussian()
+        except np.linalg.LinAlgError:
+            # positive semi-definite covariances (e.g. with zero-variance dimensions):
+            # use the eigenvalue decomposition L_k = R_k V_k^1/2, where covar_k = R_k V_k R_k^T
+            L = np.empty_like(self.covar)
+            for k in range(self.K):
+                try:
+                    L[k] = np.linalg.cholesky(self.covar[k])
+                except np.linalg.LinAlgError:
+                    val, rot = np.linalg.eigh(self.covar[k])
+                    L[k] = rot * np.sqrt(np.maximum(val, 0))
+        z = rng.standard_normal((size, self.D))
+        return self.mean[ind] + np.einsum('nij,nj->ni', L[ind], z)
 
     def __call__(self, coords, covar=None, as_log=False):
         """Evaluate model PDF at given coordinates.
@@ -293,7 +432,12 @@ class GMM(object):
         if as_log:
             return self.logL(coords, covar=covar)
         else:
-            return np.exp(self.logL(coords, covar=covar))
+            # sum_k p(x | k) without the log and exp of logsum():
+            # shift by the maximum only to avoid underflow
+            log_p = self._log_p(coords, covar=covar)
+            c = log_p.max(axis=0)
+            c = np.where(np.isfinite(c), c, 0)
+            return np.exp(c) * np.exp(log_p - c).sum(axis=0)
 
     def _mp_chunksize(self):
         # find how many components to distribute over available threads
@@ -302,24 +446,10 @@ class GMM(object):
         n_chunks = min(cpu_count, self.K//chunksize)
         return n_chunks, chunksize
 
-    def _get_chunks(self):
-        # split all component in ideal-sized chunks
-        n_chunks, chunksize = self._mp_chunksize()
-        left = self.K - n_chunks*chunksize
-        chunks = []
-        n = 0
-        for i in xrange(n_chunks):
-            n_ = n + chunksize
-            if left > i:
-                n_ += 1
-            chunks.append((n, n_))
-            n = n_
-        return chunks
-
     def logL(self, coords, covar=None):
         """Log-likelihood of coords given all (i.e. the sum of) GMM components
 
-        Distributes computation over all threads on the machine.
+        Evaluates all components at once with batched linear algebra.
 
         If covar is None, this method returns
             log(sum_k(p(x | k)))
@@ -334,25 +464,47 @@ class GMM(object):
         Returns:
             numpy array (1,) or (N, 1) log(L), depending on shape of data
         """
-        # Instead log p (x | k) for each k (which is huge)
-        # compute it in stages: first for each chunk, then sum over all chunks
-        pool = multiprocessing.Pool()
-        chunks = self._get_chunks()
-        results = [pool.apply_async(self._logsum_chunk, (chunk, coords, covar)) for chunk in chunks]
-        log_p_y_chunk = []
-        for r in results:
-            log_p_y_chunk.append(r.get())
-        pool.close()
-        pool.join()
-        return logsum(np.array(log_p_y_chunk)) # sum over all chunks = all k
-
-    def _logsum_chunk(self, chunk, coords, covar=None):
-        # helper function to reduce the memory requirement of logL
-        log_p_y_k = np.empty((chunk[1]-chunk[0], len(coords)))
-        for i in xrange(chunk[1] - chunk[0]):
-            k = chunk[0] + i
-            log_p_y_k[i,:] = self.logL_k(k, coords, covar=covar)
-        return logsum(log_p_y_k)
+        return logsum(self._log_p(coords, covar=covar)) # sum over all k
+
+    def _log_p(self, coords, covar=None):
+        # log p(x | k) for all k: array (K,) or (K, N)
+        # prepend component axis k to the sample axes of coords
+        k_ = (slice(None),) + (None,)*(np.ndim(coords) - 1)
+        if covar is None or covar.shape == (self.D, self.D):
+            # one batched Cholesky decomposition T_k = L_k L_k^T for all components
+            if covar is None:
+                L, _ = self._prepare_gaussian()
+            else:
+                L = np.linalg.cholesky(self.covar + covar)
+            if np.ndim(coords) == 1:
+                z = np.linalg.solve(L, (coords - self.mean)[...,None])[...,0]
+                chi2 = (z**2).sum(axis=-1)
+            else:
+                # one matrix for all samples of each component, on tiles of samples
+                chi2 = _chi2_tiles(coords.reshape(-1, self.D), _inv_chol(L), self.mean)
+                chi2 = chi2.reshape((self.K,) + coords.shape[:-1])
+            logdet = _logdet_chol(L)
+            logdet = logdet[k_]
+        elif self.K * covar.nbytes <= _MAX_BATCH_BYTES:
+            # T_ik = C_k + covar_i for all k at once: shape (K,N,D,D)
+            dx = coords - self.mean[k_]
+            L = np.linalg.cholesky(self.covar[:,None,:,:] + covar)
+            z = np.linalg.solve(L, dx[...,None])[...,0]
+            chi2 = (z**2).sum(axis=-1)
+            logdet = _logdet_chol(L)
+        else:
+            # T_ik = C_k + covar_i for one k at a time, reusing the buffer
+            chi2 = np.empty((self.K,) + coords.shape[:-1])
+            logdet = np.empty((self.K,) + coords.shape[:-1])
+            T_k = np.empty_like(covar)
+            for k in range(self.K):
+                np.add(self.covar[k], covar, out=T_k)
+                L_k = np.linalg.cholesky(T_k)
+                z = np.linalg.solve(L_k, (coords - self.mean[k])[...,None])[...,0]
+                chi2[k] = (z**2).sum(axis=-1)
+                logdet[k] = _logdet_chol(L_k)
+
+        return self._prepare_log_amp()[k_] - self._log2piD2 - logdet/2 - chi2/2
 
     def logL_k(self, k, coords, covar=None, chi2_only=False):
         """Log-likelihood of coords given only component k.
@@ -369,18 +521,28 @@ class GMM(object):
         # compute p(x | k)
         dx = coords - self.mean[k]
         if covar is None:
-            T_k = self.covar[k]
+            chi2, logdet = self.chi2_and_logdet(k, dx)
+        elif numba is not None and dx.ndim == 2:
+            # jit-compiled, parallel over samples
+            chi2, logdet = _chi2_logdet_numba(dx, self.covar[k], covar.reshape(-1, self.D, self.D))
+            if np.isnan(logdet).any():
+                raise np.linalg.LinAlgError("Matrix is not positive definite")
         else:
             T_k = self.covar[k] + covar
-        chi2 = np.einsum('...i,...ij,...j', dx, np.linalg.inv(T_k), dx)
+            # a single Cholesky decomposition T_k = L L^T gives both
+            # chi2 = |L^-1 dx|^2 and log(det(T_k)) = 2 sum_i log(L_ii)
+            L = np.linalg.cholesky(T_k)
+            if T_k.ndim == 2:
+                z = scipy.linalg.solve_triangular(L, dx.T, lower=True).T
+            else:
+                z = np.linalg.solve(L, dx[...,None])[...,0]
+            chi2 = np.einsum('...i,...i', z, z)
+            logdet = _logdet_chol(L)
 
         if chi2_only:
             return chi2
 
-        # prevent tiny negative determinants to mess up
-        (sign, logdet) = np.linalg.slogdet(T_k)
-        log2piD2 = np.log(2*np.pi)*(0.5*self.D)
-        return np.log(self.amp[k]) - log2piD2 - sign*logdet/2 - chi2/2
+        return self._prepare_log_amp()[k] - self._log2piD2 - logdet/2 - chi2/2
 
 class Background(object):
     """Background object to be used in conjuction with GMM.
@@ -437,6 +599,17 @@ class Background(object):
 # Begin of fit functions
 ############################
 
+def _data_extent(data):
+    # lower corner and side lengths of the box spanned by data
+    min_pos = data.min(axis=0)
+    return min_pos, data.max(axis=0) - min_pos
+
+def _default_s(vol_data, K, D):
+    # volume filling argument:
+    # K spheres of radius s [having volume s^D * pi^D/2 / gamma(D/2+1)]
+    # should completely fill the volume vol_data spanned by data.
+    return (vol_data / K * scipy.special.gamma(D*0.5 + 1))**(1/D) / np.sqrt(np.pi)
+
 def initFromDataMinMax(gmm, data, covar=None, s=None, k=None, rng=np.random):
     """Initialization callback for uniform random component means.
 
@@ -463,15 +636,11 @@ def initFromDataMinMax(gmm, data, covar=None, s=None, k=None, rng=np.random):
     gmm.amp[k] = 1/gmm.K
     # set model to random positions with equally sized spheres within
     # volumne spanned by data
-    min_pos = data.min(axis=0)
-    max_pos = data.max(axis=0)
-    gmm.mean[k,:] = min_pos + (max_pos-min_pos)*rng.rand(gmm.K, gmm.D)
-    # if s is not set: use volume filling argument:
-    # K spheres of radius s [having volume s^D * pi^D/2 / gamma(D/2+1)]
-    # should completely fill the volume spanned by data.
+    min_pos, extent = _data_extent(data)
+    gmm.mean[k,:] = min_pos + extent*rng.rand(gmm.K, gmm.D)
+    # if s is not set: use volume filling argument
     if s is None:
-        vol_data = np.prod(max_pos-min_pos)
-        s = (vol_data / gmm.K * scipy.special.gamma(gmm.D*0.5 + 1))**(1/gmm.D) / np.sqrt(np.pi)
+        s = _default_s(np.prod(extent), gmm.K, gmm.D)
         logger.info("initializing spheres with s=%.2f in data domain" % s)
 
     gmm.covar[k,:,:] = s**2 * np.eye(data.shape[1])
@@ -510,13 +679,11 @@ def initFromDataAtRandom(gmm, data, covar=None, s=None, k=None, rng=np.random):
     refs = rng.randint(0, len(data), size=k_len)
     D = data.shape[1]
     if s is None:
-        min_pos = data.min(axis=0)
-        max_pos = data.max(axis=0)
-        vol_data = np.prod(max_pos-min_pos)
-        s = (vol_data / gmm.K * scipy.special.gamma(gmm.D*0.5 + 1))**(1/gmm.D) / np.sqrt(np.pi)
+        s = _default_s(np.prod(_data_extent(data)[1]), gmm.K, gmm.D)
         logger.info("initializing spheres with s=%.2f near data points" % s)
 
-    gmm.mean[k,:] = data[refs] + rng.multivariate_normal(np.zeros(D), s**2 * np.eye(D), size=k_len)
+    # isotropic offsets: no need for multivariate_normal
+    gmm.mean[k,:] = data[refs] + s * rng.standard_normal((k_len, D))
     gmm.covar[k,:,:] = s**2 * np.eye(data.shape[1])
 
 def initFromKMeans(gmm, data, covar=None, rng=np.random):
@@ -537,14 +704,14 @@ def initFromKMeans(gmm, data, covar=None, rng=np.random):
     """
     from scipy.cluster.vq import kmeans2
     center, label = kmeans2(data, gmm.K)
-    for k in xrange(gmm.K):
+    for k in range(gmm.K):
         mask = (label == k)
         gmm.amp[k] = mask.sum() / len(data)
         gmm.mean[k,:] = data[mask].mean(axis=0)
         d_m = data[mask] - gmm.mean[k]
-        # funny way of saying: for each point i, do the outer product
-        # of d_m with its transpose and sum over i
-        gmm.covar[k,:,:] = (d_m[:, :, None] * d_m[:, None, :]).sum(axis=0) / len(data)
+        # sum over i of the outer products of d_m with itself,
+        # done as one matrix product to avoid the (N_k,D,D) intermediate
+        gmm.covar[k,:,:] = np.dot(d_m.T, d_m) / len(data)
 
 
 def fit(gmm, data, covar=None, R=None, init_method='random', w=0., cutoff=None, sel_callback=None, oversampling=10, covar_callback=None, background=None, tol=1e-3, miniter=1, maxiter=1000, frozen=None, split_n_merge=False, rng=np.random):
@@ -633,17 +800,18 @@ def fit(gmm, data, covar=None, R=None, init_method='random', w=0., cutoff=None,
     if sel_callback is not None and covar is not None and covar_callback is None:
         raise NotImplementedError("covar is set, but covar_callback is None: imputation samples inconsistent")
 
-    # set up pool
-    pool = multiprocessing.Pool()
+    # set up pool: threads suffice because the work in _Esum and _Msums is
+    # done by numpy, which releases the GIL, and they avoid pickling the data
+    pool = multiprocessing.pool.ThreadPool()
     n_chunks, chunksize = gmm._mp_chunksize()
 
     # containers
     # precautions for cases when some points are treated as outliers
     # and not considered as belonging to any component
     log_S = createShared(np.zeros(N))          # S = sum_k p(x|k)
-    log_p = [[] for k in xrange(gmm.K)]        # P = p(x|k) for x in U[k]
-    T_inv = [None for k in xrange(gmm.K)]      # T = covar(x) + gmm.covar[k]
-    U = [None for k in xrange(gmm.K)]          # U = {x close to k}
+    log_p = [[] for k in range(gmm.K)]        # P = p(x|k) for x in U[k]
+    T_chol = [None for k in range(gmm.K)]     # L with L L^T = T = covar(x) + gmm.covar[k]
+    U = [None for k in range(gmm.K)]          # U = {x close to k}
     p_bg = None
     if background is not None:
         gmm.amp *= 1 - background.amp          # GMM amp + BG amp = 1
@@ -663,19 +831,19 @@ def fit(gmm, data, covar=None, R=None, init_method='random', w=0., cutoff=None,
     changeable = {"amp": slice(None), "mean": slice(None), "covar": slice(None)}
     if frozen is not None:
         if all(isinstance(item, int) for item in frozen):
-            changeable['amp'] = changeable['mean'] = changeable['covar'] = np.in1d(xrange(gmm.K), frozen, assume_unique=True, invert=True)
+            changeable['amp'] = changeable['mean'] = changeable['covar'] = np.in1d(range(gmm.K), frozen, assume_unique=True, invert=True)
         elif hasattr(frozen, 'keys') and np.in1d(["amp","mean","covar"], tuple(frozen.keys()), assume_unique=True).any():
             if "amp" in frozen.keys():
-                changeable['amp'] = np.in1d(xrange(gmm.K), frozen['amp'], assume_unique=True, invert=True)
+                changeable['amp'] = np.in1d(range(gmm.K), frozen['amp'], assume_unique=True, invert=True)
             if "mean" in frozen.keys():
-                changeable['mean'] = np.in1d(xrange(gmm.K), frozen['mean'], assume_unique=True, invert=True)
+                changeable['mean'] = np.in1d(range(gmm.K), frozen['mean'], assume_unique=True, invert=True)
             if "covar" in frozen.keys():
-                changeable['covar'] = np.in1d(xrange(gmm.K), frozen['covar'], assume_unique=True, invert=True)
+                changeable['covar'] = np.in1d(range(gmm.K), frozen['covar'], assume_unique=True, invert=True)
         else:
             raise NotImplementedError("frozen should be list of indices or dictionary with keys in ['amp','mean','covar']")
 
     try:
-        log_L, N, N2 = _EM(gmm, log_p, U, T_inv, log_S, data_, covar=covar_, R=R, sel_callback=sel_callback, oversampling=oversampling, covar_callback=covar_callback, w=w, pool=pool, chunksize=chunksize, cutoff=cutoff, background=background, p_bg=p_bg, changeable=changeable, miniter=miniter, maxiter=maxiter, tol=tol, rng=rng)
+        log_L, N, N2 = _EM(gmm, log_p, U, T_chol, log_S, data_, covar=covar_, R=R, sel_callback=sel_callback, oversampling=oversampling, covar_callback=covar_callback, w=w, pool=pool, chunksize=chunksize, cutoff=cutoff, background=background, p_bg=p_bg, changeable=changeable, miniter=miniter, maxiter=maxiter, tol=tol, rng=rng)
     except Exception:
         # cleanup
         pool.close()
@@ -697,7 +865,7 @@ def fit(gmm, data, covar=None, R=None, init_method='random', w=0., cutoff=None,
             gmm_.amp[:] = gmm.amp[:]
             gmm_.mean[:] = gmm.mean[:,:]
             gmm_.covar[:,:,:] = gmm.covar[:,:,:]
-            U_ = [U[k].copy() for k in xrange(gmm.K)]
+            U_ = [U[k].copy() for k in range(gmm.K)]
 
             changing, cleanup = _findSNMComponents(gmm, U, log_p, log_S, N+N2, pool=pool, chunksize=chunksize)
             logger.info("merging %d and %d, splitting %d" % tuple(changing))
@@ -718,11 +886,11 @@ def fit(gmm, data, covar=None, R=None, init_method='random', w=0., cutoff=None,
             # would be over-estimated.
             # Effectively, partial runs are as expensive as full runs.
 
-            changeable['amp'] = changeable['mean'] = changeable['covar'] = np.in1d(xrange(gmm.K), changing, assume_unique=True)
-            log_L_, N_, N2_ = _EM(gmm, log_p, U, T_inv, log_S, data_, covar=covar_, R=R,  sel_callback=sel_callback, oversampling=oversampling, covar_callback=covar_callback, w=w, pool=pool, chunksize=chunksize, cutoff=cutoff, background=background, p_bg=p_bg, maxiter=maxiter, tol=tol, prefix="SNM_P", changeable=changeable, rng=rng)
+            changeable['amp'] = changeable['mean'] = changeable['covar'] = np.in1d(range(gmm.K), changing, assume_unique=True)
+            log_L_, N_, N2_ = _EM(gmm, log_p, U, T_chol, log_S, data_, covar=covar_, R=R,  sel_callback=sel_callback, oversampling=oversampling, covar_callback=covar_callback, w=w, pool=pool, chunksize=chunksize, cutoff=cutoff, background=background, p_bg=p_bg, maxiter=maxiter, tol=tol, prefix="SNM_P", changeable=changeable, rng=rng)
 
             changeable['amp'] = changeable['mean'] = changeable['covar'] = slice(None)
-            log_L_, N_, N2_ = _EM(gmm, log_p, U, T_inv, log_S, data_, covar=covar_, R=R,  sel_callback=sel_callback, oversampling=oversampling, covar_callback=covar_callback, w=w, pool=pool, chunksize=chunksize, cutoff=cutoff, background=background, p_bg=p_bg, maxiter=maxiter, tol=tol, prefix="SNM_F", changeable=changeable, rng=rng)
+            log_L_, N_, N2_ = _EM(gmm, log_p, U, T_chol, log_S, data_, covar=covar_, R=R,  sel_callback=sel_callback, oversampling=oversampling, covar_callback=covar_callback, w=w, pool=pool, chunksize=chunksize, cutoff=cutoff, background=background, p_bg=p_bg, maxiter=maxiter, tol=tol, prefix="SNM_F", changeable=changeable, rng=rng)
 
             if log_L >= log_L_:
                 # revert to backup
@@ -742,7 +910,7 @@ def fit(gmm, data, covar=None, R=None, init_method='random', w=0., cutoff=None,
     return log_L, U
 
 # run EM sequence
-def _EM(gmm, log_p, U, T_inv, log_S, data, covar=None, R=None, sel_callback=None, oversampling=10, covar_callback=None, background=None, p_bg=None, w=0, pool=None, chunksize=1, cutoff=None, miniter=1, maxiter=1000, tol=1e-3, prefix="", changeable=None, rng=np.random):
+def _EM(gmm, log_p, U, T_chol, log_S, data, covar=None, R=None, sel_callback=None, oversampling=10, covar_callback=None, background=None, p_bg=None, w=0, pool=None, chunksize=1, cutoff=None, miniter=1, maxiter=1000, tol=1e-3, prefix="", changeable=None, rng=np.random):
 
     # compute effective cutoff for chi2 in D dimensions
     if cutoff is not None:
@@ -786,10 +954,13 @@ def _EM(gmm, log_p, U, T_inv, log_S, data, covar=None, R=None, sel_callback=None
         bg_amp_ = background.amp
 
     while it < maxiter: # limit loop in case of slow convergence
-        log_L_, N, N2_, N0_ = _EMstep(gmm, log_p, U, T_inv, log_S, N0, data, covar=covar, R=R, sel_callback=sel_callback, omega=omega, oversampling=oversampling, covar_callback=covar_callback, background=background, p_bg=p_bg , w=w, pool=pool, chunksize=chunksize, cutoff=cutoff_nd, tol=tol, changeable=changeable, it=it, rng=rng)
+        log_L_, N, N2_, N0_ = _EMstep(gmm, log_p, U, T_chol, log_S, N0, data, covar=covar, R=R, sel_callback=sel_callback, omega=omega, oversampling=oversampling, covar_callback=covar_callback, background=background, p_bg=p_bg , w=w, pool=pool, chunksize=chunksize, cutoff=cutoff_nd, tol=tol, changeable=changeable, it=it, rng=rng)
 
         # check if component has moved by more than sigma/2
-        shift2 = np.einsum('...i,...ij,...j', gmm.mean - gmm_.mean, np.linalg.inv(gmm_.covar), gmm.mean - gmm_.mean)
+        # chi2 of the shift with the (cached) Cholesky factors of the backup
+        L_, _ = gmm_._prepare_gaussian()
+        z = np.array([scipy.linalg.solve_triangular(L_[k], gmm.mean[k] - gmm_.mean[k], lower=True, check_finite=False) for k in range(gmm.K)])
+        shift2 = (z**2).sum(axis=-1)
         moved = np.flatnonzero(shift2 > shift_cutoff)
         status_mess = "%s%d\t%d" % (prefix, it, N)
         if sel_callback is not None:
@@ -838,13 +1009,13 @@ def _EM(gmm, log_p, U, T_inv, log_S, data, covar=None, R=None, sel_callback=None
     return log_L, N, N2
 
 # run one EM step
-def _EMstep(gmm, log_p, U, T_inv, log_S, N0, data, covar=None, R=None, sel_callback=None, omega=None, oversampling=10, covar_callback=None, background=None, p_bg=None, w=0, pool=None, chunksize=1, cutoff=None, tol=1e-3, changeable=None, it=0, rng=np.random):
+def _EMstep(gmm, log_p, U, T_chol, log_S, N0, data, covar=None, R=None, sel_callback=None, omega=None, oversampling=10, covar_callback=None, background=None, p_bg=None, w=0, pool=None, chunksize=1, cutoff=None, tol=1e-3, changeable=None, it=0, rng=np.random):
 
-    # NOTE: T_inv (in fact (T_ik)^-1 for all samples i and components k)
-    # is very large and is unfortunately duplicated in the parallelized _Mstep.
-    # If memory is too limited, one can recompute T_inv in _Msums() instead.
-    log_L = _Estep(gmm, log_p, U, T_inv, log_S, data, covar=covar, R=R, omega=omega, background=background, p_bg=p_bg, pool=pool, chunksize=chunksize, cutoff=cutoff, it=it)
-    A,M,C,N,B = _Mstep(gmm, U, log_p, T_inv, log_S, data, covar=covar, R=R, p_bg=p_bg, pool=pool, chunksize=chunksize)
+    # NOTE: T_chol (in fact the Cholesky factors of T_ik for all samples i and components k)
+    # is very large. It is shared with the threads of _Mstep, not copied,
+    # but if memory is too limited, one can recompute T_chol in _Msums() instead.
+    log_L = _Estep(gmm, log_p, U, T_chol, log_S, data, covar=covar, R=R, omega=omega, background=background, p_bg=p_bg, pool=pool, chunksize=chunksize, cutoff=cutoff, it=it)
+    A,M,C,N,B = _Mstep(gmm, U, log_p, T_chol, log_S, data, covar=covar, R=R, p_bg=p_bg, pool=pool, chunksize=chunksize)
 
     A2 = M2 = C2 = B2 = N2 = 0
 
@@ -867,20 +1038,20 @@ def _EMstep(gmm, log_p, U, T_inv, log_S, N0, data, covar=None, R=None, sel_callb
             covar2 = createShared(covar2)
 
         N0 = N0/oversampling
-        U2 = [None for k in xrange(gmm.K)]
+        U2 = [None for k in range(gmm.K)]
 
         if len(data2) > 0:
             log_S2 = np.zeros(len(data2))
-            log_p2 = [[] for k in xrange(gmm.K)]
-            T2_inv = [None for k in xrange(gmm.K)]
+            log_p2 = [[] for k in range(gmm.K)]
+            T2_chol = [None for k in range(gmm.K)]
             R2 = None
             if background is not None:
                 p_bg2 = [None]
             else:
                 p_bg2 = None
 
-            log_L2 = _Estep(gmm, log_p2, U2, T2_inv, log_S2, data2, covar=covar2, R=R2, omega=None, background=background, p_bg=p_bg2, pool=pool, chunksize=chunksize, cutoff=cutoff, it=it)
-            A2,M2,C2,N2,B2 = _Mstep(gmm, U2, log_p2, T2_inv, log_S2, data2, covar=covar2, R=R2, p_bg=p_bg2, pool=pool, chunksize=chunksize)
+            log_L2 = _Estep(gmm, log_p2, U2, T2_chol, log_S2, data2, covar=covar2, R=R2, omega=None, background=background, p_bg=p_bg2, pool=pool, chunksize=chunksize, cutoff=cutoff, it=it)
+            A2,M2,C2,N2,B2 = _Mstep(gmm, U2, log_p2, T2_chol, log_S2, data2, covar=covar2, R=R2, p_bg=p_bg2, pool=pool, chunksize=chunksize)
 
             # normalize for oversampling
             A2 /= oversampling
@@ -908,21 +1079,43 @@ def _EMstep(gmm, log_p, U, T_inv, log_S, N0, data, covar=None, R=None, sel_callb
 
 # perform E step calculations.
 # If cutoff is set, this will also set the neighborhoods U
-def _Estep(gmm, log_p, U, T_inv, log_S, data, covar=None, R=None, omega=None, background=None, p_bg=None, pool=None, chunksize=1, cutoff=None, it=0, rng=np.random):
+def _Estep(gmm, log_p, U, T_chol, log_S, data, covar=None, R=None, omega=None, background=None, p_bg=None, pool=None, chunksize=1, cutoff=None, it=0, rng=np.random):
     # compute p(i | k) for each k independently in the pool
-    # need S = sum_k p(i | k) for further calculation
-    log_S[:] = 0
+    # need S = sum_k p(i | k) for further calculation,
+    # accumulated in log space to avoid underflow of exp(log p)
+    log_S[:] = -np.inf
+
+    # H = {i | i in neighborhood[k]} for any k, needed for outliers below;
+    # without neighborhoods or with background, H is all samples
+    if cutoff is not None and background is None:
+        H = np.zeros(len(data), dtype="bool")
+    else:
+        H = None
 
-    # H = {i | i in neighborhood[k]} for any k, needed for outliers below
-    # TODO: Use only when cutoff is set
-    H = np.zeros(len(data), dtype="bool")
+    # Cholesky factors L_k, log(det(C_k)) and log(amp_k), computed once for all workers
+    L, logdet = gmm._prepare_gaussian()
+    log_amp = gmm._prepare_log_amp()
 
-    k = 0
-    for log_p[k], U[k], T_inv[k] in \
-    parmap.starmap(_Esum, zip(xrange(gmm.K), U), gmm, data, covar, R, cutoff, pm_pool=pool, pm_chunksize=chunksize):
-        log_S[U[k]] += np.exp(log_p[k]) # actually S, not logS
-        H[U[k]] = 1
-        k += 1
+    # without neighborhoods, all components see all samples: if the errors are
+    # the same for all samples, evaluate all components at once
+    if cutoff is None and R is None and (covar is None or covar.shape == (gmm.D, gmm.D)) \
+    and all(U_k is None for U_k in U):
+        if covar is not None:
+            L = np.linalg.cholesky(gmm.covar + covar)
+            logdet = _logdet_chol(L)
+        log_p_ = _Esum_batched(gmm, data, L, logdet, log_amp, pool=pool)
+        for k in range(gmm.K):
+            log_p[k] = log_p_[k]
+            T_chol[k] = L[k] if covar is not None else None
+        log_S[:] = logsum(log_p_)
+    else:
+        k = 0
+        for log_p[k], U[k], T_chol[k] in \
+        parmap.starmap(_Esum, zip(range(gmm.K), U, L, logdet, log_amp), gmm, data, covar, R, cutoff, pm_pool=pool, pm_chunksize=chunksize):
+            log_S[U[k]] = np.logaddexp(log_S[U[k]], log_p[k])
+            if H is not None:
+                H[U[k]] = 1
+            k += 1
 
     if background is not None:
         p_bg[0] = background.amp * background.p
@@ -942,21 +1135,24 @@ def _Estep(gmm, log_p, U, T_inv, log_S, data, covar=None, R=None, omega=None, ba
                 # underrun is not a big problem here
                 error *= np.real(scipy.special.erf((data[:,d] - x0[d])/denom)  - scipy.special.erf((data[:,d] - x1[d])/denom)) / 2
             p_bg[0] *= error
-        log_S[:] = np.log(log_S + p_bg[0])
+        with np.errstate(divide='ignore'):
+            log_S[:] = np.logaddexp(log_S, np.log(p_bg[0]))
         if omega is not None:
             log_S += np.log(omega)
         log_L = log_S.sum()
     else:
-        # need log(S), but since log(0) isn't a good idea, need to restrict to H
-        log_S[H] = np.log(log_S[H])
+        # outside of H, S = 0: need to restrict to H
         if omega is not None:
             log_S += np.log(omega)
-        log_L = log_S[H].sum()
+        if H is None:
+            log_L = log_S.sum()
+        else:
+            log_L = log_S[H].sum()
 
     return log_L
 
 # compute chi^2, and apply selections on component neighborhood based in chi^2
-def _Esum(k, U_k, gmm, data, covar=None, R=None, cutoff=None):
+def _Esum(k, U_k, L_k, logdet_k, log_amp_k, gmm, data, covar=None, R=None, cutoff=None):
     # since U_k could be None, need explicit reshape
     d_ = data[U_k].reshape(-1, gmm.D)
     if covar is not None:
@@ -977,16 +1173,25 @@ def _Esum(k, U_k, gmm, data, covar=None, R=None, cutoff=None):
         dx = d_ - np.dot(R_, gmm.mean[k])
 
     if covar is None and R is None:
-         T_inv_k = None
-         chi2 = np.einsum('...i,...ij,...j', dx, np.linalg.inv(gmm.covar[k]), dx)
+        # chi2 = |L_k^-1 dx|^2 with C_k = L_k L_k^T
+        T_chol_k = None
+        z = scipy.linalg.solve_triangular(L_k, dx.T, lower=True, check_finite=False)
+        chi2 = (z**2).sum(axis=0)
     else:
-        # with data errors: need to create and return T_ik = covar_i + C_k
-        # and weight each datum appropriately
+        # with data errors: need to create T_ik = covar_i + C_k, and return its
+        # Cholesky factors L_ik to weight each datum appropriately
         if R is None:
-            T_inv_k = np.linalg.inv(gmm.covar[k] + covar_)
+            T_k = gmm.covar[k] + covar_
         else: # need to project out missing elements: T_ik = R_i C_k R_i^R + covar_i
-            T_inv_k = np.linalg.inv(np.einsum('...ij,jk,...lk', R_, gmm.covar[k], R_) + covar_)
-        chi2 = np.einsum('...i,...ij,...j', dx, T_inv_k, dx)
+            T_k = np.einsum('...ij,jk,...lk', R_, gmm.covar[k], R_) + covar_
+        T_chol_k = np.linalg.cholesky(T_k)
+        # chi2 = |L_ik^-1 dx|^2
+        if T_chol_k.ndim == 2: # one-for-all
+            z = scipy.linalg.solve_triangular(T_chol_k, dx.T, lower=True, check_finite=False)
+            chi2 = (z**2).sum(axis=0)
+        else:
+            z = np.linalg.solve(T_chol_k, dx[...,None])[...,0]
+            chi2 = (z**2).sum(axis=-1)
 
     # NOTE: close to convergence, we could stop applying the cutoff because
     # changes to U will be minimal
@@ -994,24 +1199,54 @@ def _Esum(k, U_k, gmm, data, covar=None, R=None, cutoff=None):
         indices = chi2 < cutoff
         chi2 = chi2[indices]
         if (covar is not None and covar.shape != (gmm.D, gmm.D)) or R is not None:
-            T_inv_k = T_inv_k[indices]
+            T_chol_k = T_chol_k[indices]
         if U_k is None:
             U_k = np.flatnonzero(indices)
         else:
             U_k = U_k[indices]
 
-    # prevent tiny negative determinants to mess up
     if covar is None:
-        (sign, logdet) = np.linalg.slogdet(gmm.covar[k])
+        logdet = logdet_k
     else:
-        (sign, logdet) = np.linalg.slogdet(T_inv_k)
-        sign *= -1 # since det(T^-1) = 1/det(T)
-
-    log2piD2 = np.log(2*np.pi)*(0.5*gmm.D)
-    return np.log(gmm.amp[k]) - log2piD2 - sign*logdet/2 - chi2/2, U_k, T_inv_k
+        logdet = _logdet_chol(T_chol_k)
+
+    return log_amp_k - gmm._log2piD2 - logdet/2 - chi2/2, U_k, T_chol_k
+
+# compute log p(x | k) of all samples for all components at once:
+# L_k L_k^T = C_k (+ the covariance shared by all samples)
+def _Esum_batched(gmm, data, L, logdet, log_amp, pool=None):
+    # chi2 in _ESTEP_DTYPE, the sum with the normalization in double precision
+    L_inv = _inv_chol(L).astype(_ESTEP_DTYPE, copy=False)
+    mean_ = gmm.mean.astype(_ESTEP_DTYPE, copy=False)
+    chi2 = _chi2_tiles(data, L_inv, mean_, pool=pool)
+    return (log_amp - gmm._log2piD2 - logdet/2)[:,None] - chi2/2
+
+# invert the triangular factors once, so that chi2 needs only matrix
+# products: chi2 = |L_k^-1 dx|^2
+def _inv_chol(L):
+    I = np.eye(L.shape[-1])
+    return np.array([scipy.linalg.solve_triangular(L_k, I, lower=True, check_finite=False) for L_k in L])
+
+# compute chi^2 of all samples for all components, with L_inv from _inv_chol:
+# work on tiles of samples so that the (K,tile,D) temporaries stay in cache,
+# the tiles are distributed over the pool
+def _chi2_tiles(data, L_inv, mean, pool=None):
+    chi2 = np.empty((len(L_inv), len(data)))
+    starts = range(0, len(data), _TILE)
+    for start, chi2_ in zip(starts, parmap.map(_chi2_tile, starts, data, L_inv, mean, pm_pool=pool, pm_parallel=pool is not None)):
+        chi2[:,start:start+_TILE] = chi2_
+    return chi2
+
+# compute chi^2 of the samples in one tile for all components
+def _chi2_tile(start, data, L_inv, mean):
+    tile = slice(start, start + _TILE)
+    # (K,D,tile): one matrix for all samples of each component
+    dx = data[None,tile,:].astype(L_inv.dtype, copy=False).transpose(0,2,1) - mean[:,:,None]
+    z = np.matmul(L_inv, dx)
+    return (z**2).sum(axis=-2)
 
 # get zeroth, first, second moments of the data weighted with p_k(x) avgd over x
-def _Mstep(gmm, U, log_p, T_inv, log_S, data, covar=None, R=None, p_bg=None, pool=None, chunksize=1):
+def _Mstep(gmm, U, log_p, T_chol, log_S, data, covar=None, R=None, p_bg=None, pool=None, chunksize=1):
 
     # save the M sums from observed data
     A = np.empty(gmm.K)                 # sum for amplitudes
@@ -1022,10 +1257,21 @@ def _Mstep(gmm, U, log_p, T_inv, log_S, data, covar=None, R=None, p_bg=None, poo
     # perform sums for M step in the pool
     # NOTE: in a partial run, could work on changeable components only;
     # however, there seem to be side effects or race conditions
-    k = 0
-    for A[k], M[k,:], C[k,:,:] in \
-    parmap.starmap(_Msums, zip(xrange(gmm.K), U, log_p, T_inv), gmm, data, R, log_S, pm_pool=pool, pm_chunksize=chunksize):
-        k += 1
+    if R is None and all(U_k is None for U_k in U) and all(T_chol_k is None for T_chol_k in T_chol):
+        # data without errors and neighborhoods: all components at once,
+        # the tiles of samples are distributed over the pool
+        log_q = np.array(log_p) - log_S
+        A[:], M[:], C[:] = 0, 0, 0
+        starts = range(0, N, _TILE)
+        for A_, M_, C_ in parmap.map(_Msums_tile, starts, gmm, data, log_q, pm_pool=pool):
+            A += A_
+            M += M_
+            C += C_
+    else:
+        k = 0
+        for A[k], M[k,:], C[k,:,:] in \
+        parmap.starmap(_Msums, zip(range(gmm.K), U, log_p, T_chol), gmm, data, R, log_S, pm_pool=pool, pm_chunksize=chunksize):
+            k += 1
 
     if p_bg is not None:
         q_bg = p_bg[0] / np.exp(log_S)
@@ -1035,60 +1281,82 @@ def _Mstep(gmm, U, log_p, T_inv, log_S, data, covar=None, R=None, p_bg=None, poo
 
     return A,M,C,N,B
 
+# compute moments for the Mstep of the samples in one tile for all components
+def _Msums_tile(start, gmm, data, log_q):
+    tile = slice(start, start + _TILE)
+    q = np.exp(log_q[:,tile])
+    d = data[tile]
+    # (K,tile,D)
+    d_m = d[None,:,:] - gmm.mean[:,None,:]
+    # A_k = sum_i q_ik, M_k = sum_i x_i q_ik, C_k = sum_i (x_i - mu_k)^T(x_i - mu_k) q_ik
+    return q.sum(axis=1), np.dot(q, d), np.matmul((d_m * q[:,:,None]).transpose(0,2,1), d_m)
+
 # compute moments for the Mstep
-def _Msums(k, U_k, log_p_k, T_inv_k, gmm, data, R, log_S):
+def _Msums(k, U_k, log_p_k, T_chol_k, gmm, data, R, log_S):
     if log_p_k.size == 0:
         return 0,0,0
 
     # get log_q_ik by dividing with S = sum_k p_ik
-    # NOTE:  this modifies log_p_k in place, but is only relevant
-    # within this method since the call is parallel and its arguments
-    # therefore don't get updated across components.
+    # NOTE: not in place because the pool threads share log_p with the caller
 
     # NOTE: reshape needed when U_k is None because of its
     # implicit meaning as np.newaxis
-    log_p_k -= log_S[U_k].reshape(log_p_k.size)
+    log_p_k = log_p_k - log_S[U_k].reshape(log_p_k.size)
     d = data[U_k].reshape((log_p_k.size, gmm.D))
     if R is not None:
         R_ = R[U_k].reshape((log_p_k.size, gmm.D, gmm.D))
 
+    # in fact: q_ik, but we treat sample index i silently everywhere
+    # exponentiate once, shifted by the maximum to sum with full precision
+    m = log_p_k.max()
+    q_k = np.exp(log_p_k - m)
+
     # amplitude: A_k = sum_i q_ik
-    A_k = np.exp(logsum(log_p_k))
+    A_k = q_k.sum() * np.exp(m)
+    q_k *= np.exp(m)
 
-    # in fact: q_ik, but we treat sample index i silently everywhere
-    q_k = np.exp(log_p_k)
+    # data with errors?
+    if T_chol_k is None and R is None and numba is not None:
+        M_k, C_k = _moments_numba(d, q_k, gmm.mean[k])
+        return A_k, M_k, C_k
 
     if R is None:
         d_m = d - gmm.mean[k]
     else:
         d_m = d - np.dot(R_, gmm.mean[k])
 
-    # data with errors?
-    if T_inv_k is None and R is None:
+    if T_chol_k is None and R is None:
         # mean: M_k = sum_i x_i q_ik
-        M_k = (d * q_k[:,None]).sum(axis=0)
+        M_k = np.dot(q_k, d)
 
         # covariance: C_k = sum_i (x_i - mu_k)^T(x_i - mu_k) q_ik
-        # funny way of saying: for each point i, do the outer product
-        # of d_m with its transpose, multiply with pi[i], and sum over i
-        C_k = (q_k[:, None, None] * d_m[:, :, None] * d_m[:, None, :]).sum(axis=0)
+        # as one matrix product, without the (N,D,D) outer products
+        C_k = np.dot((d_m * q_k[:,None]).T, d_m)
     else:
-        if R is None: # that means T_ik is not None
-            # b_ik = mu_k + C_k T_ik^-1 (x_i - mu_k)
-            # B_ik = C_k - C_k T_ik^-1 C_k
-            b_k = gmm.mean[k] + np.einsum('ij,...jk,...k', gmm.covar[k], T_inv_k, d_m)
-            B_k = gmm.covar[k] - np.einsum('ij,...jk,...kl', gmm.covar[k], T_inv_k, gmm.covar[k])
+        # with T_ik = P_i C_k P_i^T + covar_i = L_ik L_ik^T, where P_i = R_i or 1,
+        # and H_ik = L_ik^-1 P_i C_k:
+        # b_ik = mu_k + C_k P_i^T T_ik^-1 (x_i - P_i mu_k) = mu_k + H_ik^T L_ik^-1 (x_i - P_i mu_k)
+        # B_ik = C_k - C_k P_i^T T_ik^-1 P_i C_k = C_k - H_ik^T H_ik
+        # one solve for both right-hand sides [P_i C_k, x_i - P_i mu_k]
+        if T_chol_k.ndim == 2: # one-for-all
+            X_k = scipy.linalg.solve_triangular(T_chol_k, np.concatenate([gmm.covar[k], d_m.T], axis=-1), lower=True, check_finite=False)
+            H_k, z_k = X_k[:,:gmm.D], X_k[:,gmm.D:].T
         else:
-            # F_ik = C_k R_i^T T_ik^-1
-            F_k = np.einsum('ij,...kj,...kl', gmm.covar[k], R_, T_inv_k)
-            b_k = gmm.mean[k] + np.einsum('...ij,...j', F_k, d_m)
-            B_k = gmm.covar[k] - np.einsum('...ij,...jk,kl', F_k, R_, gmm.covar[k])
-
-            #b_k = gmm.mean[k] + np.einsum('ij,...jk,...k', gmm.covar[k], T_inv_k, d_m)
-            #B_k = gmm.covar[k] - np.einsum('ij,...jk,...kl', gmm.covar[k], T_inv_k, gmm.covar[k])
-        M_k = (b_k * q_k[:,None]).sum(axis=0)
+            if R is None:
+                PC_k = np.broadcast_to(gmm.covar[k], T_chol_k.shape)
+            else:
+                PC_k = np.einsum('...ij,jk', R_, gmm.covar[k])
+            X_k = np.linalg.solve(T_chol_k, np.concatenate([PC_k, d_m[...,None]], axis=-1))
+            H_k, z_k = X_k[...,:-1], X_k[...,-1]
+        b_k = gmm.mean[k] + np.einsum('...ji,...j', H_k, z_k)
+        B_k = gmm.covar[k] - np.einsum('...ji,...jk', H_k, H_k)
+        M_k = np.dot(q_k, b_k)
         b_k -= gmm.mean[k]
-        C_k = (q_k[:, None, None] * (b_k[:, :, None] * b_k[:, None, :] + B_k)).sum(axis=0)
+        C_k = np.dot((b_k * q_k[:,None]).T, b_k)
+        if B_k.ndim == 2: # same for all i: sum_i q_ik B_k = A_k B_k
+            C_k += A_k * B_k
+        else:
+            C_k += np.tensordot(q_k, B_k, axes=1)
     return A_k, M_k, C_k
 
 
@@ -1116,6 +1384,11 @@ def _update(gmm, A, M, C, N, B, A2, M2, C2, N2, B2, w, changeable=None, backgrou
     gmm.mean[changeable['mean'],:] = (M + M2)[changeable['mean'],:]/(A + A2)[changeable['mean'],None]
 
     # covar updateL
+    # NOTE: works in place on C (a view of it if all components change),
+    # which isn't needed after the update
+    C_ = C[changeable['covar'],:,:]
+    if np.ndim(C2):
+        C_ += C2[changeable['covar'],:,:]
     # minimum covariance term?
     if w > 0:
         # we assume w to be a lower bound of the isotropic dispersion,
@@ -1124,9 +1397,17 @@ def _update(gmm, A, M, C, N, B, A2, M2, C2, N2, B2, w, changeable=None, backgrou
         # prefactor 1 / (q_j + 1) = 1 / (A + 1) in our terminology
         # On average, q_j = N/K, so we'll adopt that to correct.
         w_eff = w**2 * ((N+N2)/gmm.K + 1)
-        gmm.covar[changeable['covar'],:,:] = (C + C2 + w_eff*np.eye(gmm.D)[None,:,:])[changeable['covar'],:,:] / (A + A2 + 1)[changeable['covar'],None,None]
+        # add to the diagonal only, through its writable view
+        np.einsum('kii->ki', C_)[...] += w_eff
+        C_ /= (A + A2 + 1)[changeable['covar'],None,None]
     else:
-        gmm.covar[changeable['covar'],:,:] = (C + C2)[changeable['covar'],:,:] / (A + A2)[changeable['covar'],None,None]
+        C_ /= (A + A2)[changeable['covar'],None,None]
+    gmm.covar[changeable['covar'],:,:] = C_
+
+    # factorize the new covariances (and take the log of the amplitudes) once
+    # here, so that subsequent evaluations of the model (by all threads) share them
+    gmm._prepare_gaussian()
+    gmm._prepare_log_amp()
 
 # draw from the model (+ background) and apply appropriate covariances
 def _drawGMM_BG(gmm, size, covar_callback=None, background=None, rng=np.random):
@@ -1148,14 +1429,27 @@ def _drawGMM_BG(gmm, size, covar_callback=None, background=None, rng=np.random):
         if covar2.shape == (gmm.D, gmm.D): # one-for-all
             noise = rng.multivariate_normal(np.zeros(gmm.D), covar2, size=len(data2))
         else:
-            # create noise from unit covariance and then dot with eigenvalue
+            # create noise from unit covariance and then dot with Cholesky
             # decomposition of covar2 to get a the right noise distribution:
-            # n' = R V^1/2 n, where covar = R V R^-1
+            # n' = L n, where covar = L L^T
             # faster than drawing one sample per each covariance
-            noise = rng.multivariate_normal(np.zeros(gmm.D), np.eye(gmm.D), size=len(data2))
-            val, rot = np.linalg.eigh(covar2)
-            val = np.maximum(val,0) # to prevent univariate errors to underflow
-            noise = np.einsum('...ij,...j', rot, np.sqrt(val)*noise)
+            noise = rng.standard_normal((len(data2), gmm.D))
+            try:
+                if numba is not None:
+                    # jit-compiled, parallel over samples
+                    noise_ = _noise_numba(covar2, noise)
+                    if np.isnan(noise_).any():
+                        raise np.linalg.LinAlgError("Matrix is not positive definite")
+                    noise = noise_
+                else:
+                    L = np.linalg.cholesky(covar2)
+                    noise = np.matmul(L, noise[...,None])[...,0]
+            except np.linalg.LinAlgError:
+                # singular covariances: use eigenvalue decomposition instead
+                # n' = R V^1/2 n, where covar = R V R^-1
+                val, rot = np.linalg.eigh(covar2)
+                val = np.maximum(val,0) # to prevent univariate errors to underflow
+                noise = np.einsum('...ij,...j', rot, np.sqrt(val)*noise)
         data2 += noise
     else:
         covar2 = None
@@ -1241,18 +1535,26 @@ def _JS(k, gmm, log_p, log_S, U, A):
 
 def _findSNMComponents(gmm, U, log_p, log_S, N, pool=None, chunksize=1):
     # find those components that are most similar
-    JM = np.zeros((gmm.K, gmm.K))
-    # compute log_q (posterior for k given i), but use normalized probabilities
+    # compute q (posterior for k given i), but use normalized probabilities
     # to allow for merging of empty components
-    log_q = [log_p[k] - log_S[U[k]] - np.log(gmm.amp[k]) for k in xrange(gmm.K)]
-    for k in xrange(gmm.K):
-        # don't need diagonal (can merge), and JM is symmetric
-        for j in xrange(k+1, gmm.K):
-            # get index list for intersection of U of k and l
-            # FIXME: match1d fails if either U is empty
-            # SOLUTION: merge empty U, split another
-            i_k, i_j = match1d(U[k], U[j], presorted=True)
-            JM[k,j] = np.dot(np.exp(log_q[k][i_k]), np.exp(log_q[j][i_j]))
+    # Q_ki = q_ik for i in U[k], 0 otherwise, so that JM = Q Q^T
+    N_ = len(log_S)
+    q = [np.exp(log_p[k] - log_S[U[k]] - np.log(gmm.amp[k])).reshape(-1) for k in range(gmm.K)]
+    # sparse Q if the neighborhoods cover only a small fraction of the samples
+    n_q = sum(q_k.size for q_k in q)
+    if gmm.K * N_ * 8 <= _MAX_BATCH_BYTES and n_q >= 0.1 * gmm.K * N_:
+        Q = np.zeros((gmm.K, N_))
+        for k in range(gmm.K):
+            Q[k, U[k]] = q[k]
+        JM = np.dot(Q, Q.T)
+    else:
+        # sparse: only the neighborhoods are stored
+        rows = np.concatenate([np.full(q[k].size, k) for k in range(gmm.K)])
+        cols = np.concatenate([np.arange(N_) if U[k] is None else U[k] for k in range(gmm.K)])
+        Q = scipy.sparse.csr_matrix((np.concatenate(q), (rows, cols)), shape=(gmm.K, N_))
+        JM = Q.dot(Q.T).toarray()
+    # don't need diagonal (can merge), and JM is symmetric
+    JM = np.triu(JM, 1)
     merge_jk = np.unravel_index(JM.argmax(), JM.shape)
     # if all Us are disjunct, JM is blank and merge_jk = [0,0]
     # merge two smallest components and clean up from the bottom
@@ -1270,16 +1572,16 @@ def _findSNMComponents(gmm, U, log_p, log_S, N, pool=None, chunksize=1):
     k = 0
     A = gmm.amp * N
     for JS[k] in \
-    parmap.map(_JS, xrange(gmm.K), gmm, log_p, log_S, U, A, pm_pool=pool, pm_chunksize=chunksize):
+    parmap.map(_JS, range(gmm.K), gmm, log_p, log_S, U, A, pm_pool=pool, pm_chunksize=chunksize):
         k += 1
     """
     # get largest Eigenvalue, weighed by amplitude
     # Large EV implies extended object, which often is caused by coverving
     # multiple clusters. This happes also for almost empty components, which
     # should rather be merged than split, hence amplitude weights.
-    # TODO: replace with linalg.eigvalsh, but eigenvalues are not always ordered
-    EV = np.linalg.svd(gmm.covar, compute_uv=False)
-    JS = EV[:,0] * gmm.amp
+    # eigvalsh returns the Eigenvalues in ascending order
+    EV = np.linalg.eigvalsh(gmm.covar)
+    JS = EV[:,-1] * gmm.amp
     split_l3 = np.argsort(JS)[-3:][::-1]
 
     # check that the three indices are unique
@@ -1314,14 +1616,18 @@ def _update_snm(gmm, changeable, U, N, cleanup):
     # split 2, store in 1 and 2
     # following SVD method in Zhang 2003, with alpha=1/2, u = 1/4
     gmm.amp[changeable[1]] = gmm.amp[changeable[2]] = gmm.amp[changeable[2]] / 2
-    # TODO: replace with linalg.eigvalsh, but eigenvalues are not always ordered
-    _, radius2, rotation = np.linalg.svd(gmm.covar[changeable[2]])
-    dl = np.sqrt(radius2[0]) *  rotation[0] / 4
+    # along the Eigenvector with the largest Eigenvalue (the last one from eigh)
+    radius2, rotation = np.linalg.eigh(gmm.covar[changeable[2]])
+    dl = np.sqrt(radius2[-1]) *  rotation[:,-1] / 4
     gmm.mean[changeable[1]] = gmm.mean[changeable[2]] - dl
     gmm.mean[changeable[2]] = gmm.mean[changeable[2]] + dl
     gmm.covar[changeable[1:]] = np.linalg.det(gmm.covar[changeable[2]])**(1/gmm.D) * np.eye(gmm.D)
     U[changeable[1]] = U[changeable[2]].copy() # now 1 and 2 have same U
 
+    # refactorize the altered components for the next E-step
+    gmm._prepare_gaussian()
+    gmm._prepare_log_amp()
+
 
 # L-fold cross-validation of the fit function.
 # all parameters for fit must be supplied with kwargs.
@@ -1357,7 +1663,7 @@ def cv_fit(gmm, data, L=10, **kwargs):
 
     # to L-fold CV here, need to split covar too if set
     covar = kwargs.pop("covar", None)
-    for i in xrange(L):
+    for i in range(L):
         rng.set_state(rng_state)
         mask = np.arange(N) % L == i
         if covar is None or covar.shape == (gmm.D, gmm.D):
@@ -1380,7 +1686,7 @@ def cv_fit(gmm, data, L=10, **kwargs):
 def stack(gmms, weights):
     # build stacked model by combining all gmms and applying weights to amps
     stacked = GMM(K=0, D=gmms[0].D)
-    for m in xrange(len(gmms)):
+    for m in range(len(gmms)):
         stacked.amp = np.concatenate((stacked.amp[:], weights[m]*gmms[m].amp[:]))
         stacked.mean = np.concatenate((stacked.mean[:,:], gmms[m].mean[:,:]))
         stacked.covar = np.concatenate((stacked.covar[:,:,:], gmms[m].covar[:,:,:]))
@@ -1393,7 +1699,7 @@ def stack_fit(gmms, data, kwargs, L=10, tol=1e-5, rng=np.random):
     N = len(data)
     lcvs = np.empty((M,N))
 
-    for m in xrange(M):
+    for m in range(M):
         # run CV to get cross-validation likelihood
         rng_state = rng.get_state()
         lcvs[m,:] = cv_fit(gmms[m], data, L=L, **(kwargs[m]))
@@ -1404,17 +1710,19 @@ def stack_fit(gmms, data, kwargs, L=10, tol=1e-5, rng=np.random):
     # determine the weights that maximize the stacked estimator likelihood
     # run a tiny EM on lcvs to get them
     beta = np.ones(M)/M
+    # buffers are reused in every iteration
     log_p_k = np.empty_like(lcvs)
     log_S = np.empty(N)
+    log_N = np.log(N)
     it = 0
     logger.info("optimizing stacking weights\n")
     logger.info("ITER\tLOG_L")
 
     while True and it < 20:
-        log_p_k[:,:] = lcvs + np.log(beta)[:,None]
+        np.add(lcvs, np.log(beta)[:,None], out=log_p_k)
         log_S[:] = logsum(log_p_k)
-        log_p_k[:,:] -= log_S
-        beta[:] = np.exp(logsum(log_p_k, axis=1)) / N
+        log_p_k -= log_S
+        beta[:] = np.exp(logsum(log_p_k, axis=1) - log_N)
         logL_ = log_S.mean()
         logger.info("STACK%d\t%.4f" % (it, logL_))
 
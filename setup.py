@@ -20,7 +20,9 @@ setup(
         "Intended Audience :: Science/Research",
         "Operating System :: OS Independent",
         "Programming Language :: Python",
+        "Programming Language :: Python :: 3",
         "Topic :: Scientific/Engineering :: Information Analysis"
     ],
+    python_requires=">=3",
     install_requires=["numpy","scipy","parmap>=1.5.2"]
 )
@@ -0,0 +1,126 @@
+#!/bin/env python
+
+# compare the numba kernels with their numpy code paths
+# (pygmmis.numba = None selects the numpy path)
+
+import pygmmis
+import numpy as np
+from numpy.random import RandomState
+
+def randomCovar(N, D, rng=np.random):
+    # random positive definite matrices, shape (N,D,D)
+    A = rng.normal(size=(N,D,D))
+    return np.matmul(A, A.transpose(0,2,1)) + 0.1*np.eye(D)
+
+def randomGMM(K, D, rng=np.random):
+    gmm = pygmmis.GMM(K=K, D=D)
+    gmm.amp[:] = rng.dirichlet(np.ones(K))
+    gmm.mean[:,:] = rng.normal(size=(K,D))
+    gmm.covar[:,:,:] = randomCovar(K, D, rng=rng)
+    return gmm
+
+def numpyPath(func, *args, **kwargs):
+    # run func with the numba kernels disabled
+    numba = pygmmis.numba
+    pygmmis.numba = None
+    try:
+        return func(*args, **kwargs)
+    finally:
+        pygmmis.numba = numba
+
+def checkLogL_k(gmm, coords, rng=np.random):
+    N, D = coords.shape
+    for covar in [randomCovar(1, D, rng=rng)[0], randomCovar(N, D, rng=rng)]:
+        for k in range(gmm.K):
+            logL = gmm.logL_k(k, coords, covar=covar)
+            logL_ = numpyPath(gmm.logL_k, k, coords, covar=covar)
+            assert np.allclose(logL, logL_, rtol=1e-10, atol=0)
+
+    # no samples: covar[0] must not be accessed
+    chi2, logdet = pygmmis._chi2_logdet_numba(np.empty((0,D)), gmm.covar[0], np.empty((0,D,D)))
+    assert chi2.shape == logdet.shape == (0,)
+
+def checkMsums(gmm, coords, rng=np.random):
+    # moments of error-free data, for all samples and for a neighborhood
+    log_p = np.array([gmm.logL_k(k, coords) for k in range(gmm.K)])
+    log_S = pygmmis.logsum(log_p)
+    U = rng.rand(len(coords)) < 0.5
+    for k in range(gmm.K):
+        for U_k, log_p_k in [(None, log_p[k]), (np.flatnonzero(U), log_p[k][U])]:
+            sums = pygmmis._Msums(k, U_k, log_p_k, None, gmm, coords, None, log_S)
+            sums_ = numpyPath(pygmmis._Msums, k, U_k, log_p_k, None, gmm, coords, None, log_S)
+            for s, s_ in zip(sums, sums_):
+                assert np.allclose(s, s_, rtol=1e-10, atol=0)
+
+def checkNotPositiveDefinite(gmm, coords, rng=np.random):
+    # the kernel flags T_ik that are not positive definite with nan,
+    # logL_k must raise as the numpy path does
+    N, D = coords.shape
+    covar = randomCovar(N, D, rng=rng)
+    covar[N//2] = -10*np.eye(D)
+    chi2, logdet = pygmmis._chi2_logdet_numba(coords - gmm.mean[0], gmm.covar[0], covar)
+    assert np.isnan(logdet[N//2])
+    assert np.isfinite(np.delete(logdet, N//2)).all()
+    for func in [gmm.logL_k, lambda *args, **kwargs: numpyPath(gmm.logL_k, *args, **kwargs)]:
+        try:
+            func(0, coords, covar=covar)
+        except np.linalg.LinAlgError:
+            pass
+        else:
+            raise AssertionError("LinAlgError not raised")
+
+def checkNoise(gmm, size, rng=np.random):
+    # per-sample noise in _drawGMM_BG, with the eigenvalue fallback
+    # when a covariance is only positive semi-definite
+    D = gmm.D
+    covar = randomCovar(size, D, rng=rng)
+    for singular in [False, True]:
+        if singular:
+            covar[size//2] = np.diag(np.arange(D))
+        covar_callback = lambda coords: covar
+        seed = rng.randint(10000)
+        data, _ = pygmmis._drawGMM_BG(gmm, size, covar_callback=covar_callback, rng=RandomState(seed))
+        data_, _ = numpyPath(pygmmis._drawGMM_BG, gmm, size, covar_callback=covar_callback, rng=RandomState(seed))
+        assert np.isfinite(data).all()
+        assert np.allclose(data, data_, rtol=1e-10, atol=1e-12)
+
+def checkDrawSingular(D, size, rng=np.random):
+    # GMM.draw from a component without variance along one axis
+    gmm = pygmmis.GMM(K=1, D=D)
+    gmm.amp[:] = 1
+    gmm.mean[:,:] = rng.normal(size=(1,D))
+    gmm.covar[0] = np.diag(np.arange(D))
+    data = gmm.draw(size, rng=rng)
+    assert (data[:,0] == gmm.mean[0,0]).all()
+    assert np.allclose(np.cov(data, rowvar=False), gmm.covar[0], rtol=0, atol=0.05)
+
+def checkMatch1d(rng=np.random):
+    # compare with brute-force matching of all pairs
+    arr1 = rng.permutation(100)[:50]
+    arr2 = rng.randint(0, 100, size=200)
+    pairs = set((i,j) for i in range(len(arr1)) for j in range(len(arr2)) if arr1[i] == arr2[j])
+    ind1, ind2 = pygmmis.match1d(arr1, arr2)
+    assert set(zip(ind1, ind2)) == pairs and len(ind1) == len(pairs)
+    st1 = np.argsort(arr1)
+    ind1, ind2 = pygmmis.match1d(arr1[st1], arr2, presorted=True)
+    assert set(zip(st1[ind1], ind2)) == pairs and len(ind1) == len(pairs)
+
+if __name__ == "__main__":
+    rng = RandomState(42)
+    K = 5
+    D = 3
+    N = 1000
+
+    gmm = randomGMM(K, D, rng=rng)
+    coords = gmm.draw(N, rng=rng)
+
+    if pygmmis.numba is None:
+        print ("numba not available: no kernels to compare")
+    else:
+        checkLogL_k(gmm, coords, rng=rng)
+        checkNotPositiveDefinite(gmm, coords, rng=rng)
+        checkMsums(gmm, coords, rng=rng)
+        checkNoise(gmm, N, rng=rng)
+    checkDrawSingular(D, 100000, rng=rng)
+    checkMatch1d(rng=rng)
+    print ("all checks passed")